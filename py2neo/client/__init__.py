@@ -1090,9 +1090,14 @@ class Transaction(object):
         else:
             return False
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
 
 class Result(object):
 
+    __slots__ = ("_graph_name",)
+
     def __init__(self, graph_name):
         super(Result, self).__init__()
         self._graph_name = graph_name
@@ -251,7 +251,6 @@ def bolt_user_agent():
 
 def http_user_agent():
     import py2neo
-    import urllib3
-    fields = ((py2neo.__package__, py2neo.__version__, urllib3.__version__) +
+    fields = ((py2neo.__package__, py2neo.__version__) +
               tuple(version_info) + (platform,))
-    return "{}/{} urllib3/{} Python/{}.{}.{}-{}-{} ({})".format(*fields)
+    return "{}/{} Python/{}.{}.{}-{}-{} ({})".format(*fields)
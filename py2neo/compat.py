@@ -28,6 +28,11 @@ try:
 except ImportError:
     from collections import Sequence, Set, Mapping
 
+try:
+    from http.client import BadStatusLine, HTTPConnection, HTTPSConnection
+except ImportError:
+    from httplib import BadStatusLine, HTTPConnection, HTTPSConnection
+
 try:
     from urllib.parse import urlparse, urlsplit
 except ImportError:
@@ -58,9 +58,9 @@ package_metadata = {
         "prompt_toolkit~=2.0.7",
         "pygments~=2.3.1",
         "pytz",
-        "urllib3",
     ],
     "extras_require": {
+        "orjson": ["orjson; python_version >= '3.6'"],
     },
     "license": py2neo.__license__,
     "classifiers": [